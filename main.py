@@ -1,8 +1,7 @@
-import matplotlib
-matplotlib.use('Agg')  # Backend sin GUI para Docker
-import matplotlib.pyplot as plt
-plt.ioff()  # Desactivar modo interactivo
 import os
+# Backend sin GUI para Docker. Se fija por entorno en lugar de importar matplotlib
+# aquí: así solo se carga cuando se genera el primer mapa
+os.environ["MPLBACKEND"] = "Agg"
 import sys
 import logging
 from dotenv import load_dotenv
@@ -20,13 +19,16 @@ load_dotenv()
 DEBUG = os.getenv("DEBUG", "False") == "True"
 PORT = int(os.getenv("PORT", 8080))
 CATASTRO_API_TOKEN = os.getenv("CATASTRO_TOKEN", "default_secret")
+# Con un proxy (nginx) delante sirviendo /outputs directamente desde disco, poner a False
+SERVE_OUTPUTS = os.getenv("SERVE_OUTPUTS", "True") == "True"
 
 logger.info(f"DEBUG: {DEBUG}, PORT: {PORT}")
 
 import json
-import shutil
+from io import BytesIO
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Body
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
 
@@ -36,7 +38,8 @@ logger.info("Importaciones básicas completadas")
 from urban_analysis import AnalizadorUrbanistico
 from vector_analyzer import VectorAnalyzer
 
-app = FastAPI(title="Catastro-tool")
+# orjson serializa las respuestas bastante más rápido que el json de la stdlib
+app = FastAPI(title="Catastro-tool", default_response_class=ORJSONResponse)
 
 # 1. CONFIGURACIÓN DE RUTAS (Adaptadas para Docker/Easypanel)
 BASE_DIR = Path(__file__).resolve().parent
@@ -51,7 +54,10 @@ CAPAS_DIR.mkdir(exist_ok=True)
 # 2. MONTAR ARCHIVOS ESTÁTICOS
 # Importante: Esto permite que Easypanel sirva el HTML, CSS, JS y las imágenes generadas
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
-app.mount("/outputs", StaticFiles(directory=str(OUTPUT_DIR)), name="outputs")
+# Los PNG/PDF/KML generados pesan; si hay un proxy delante es mejor que los sirva él
+# (sendfile) y no pasen por Python
+if SERVE_OUTPUTS:
+    app.mount("/outputs", StaticFiles(directory=str(OUTPUT_DIR)), name="outputs")
 
 # Instanciar motores de análisis
 urban_engine = AnalizadorUrbanistico(output_base_dir=str(OUTPUT_DIR))
@@ -74,14 +80,16 @@ async def query_catastro(data: dict = Body(...)):
         raise HTTPException(status_code=400, detail="Falta referencia")
     
     # 1. Obtener Geometría (Módulo Urban Analysis)
-    catastro_data = urban_engine.obtener_datos_catastrales(ref)
+    # El trabajo es bloqueante (disco, GDAL, matplotlib): se ejecuta en el threadpool
+    # para no parar el event loop mientras se atiende la consulta
+    catastro_data = await run_in_threadpool(urban_engine.obtener_datos_catastrales, ref)
     
     if catastro_data["status"] == "error":
-        return JSONResponse(status_code=500, content=catastro_data)
+        return ORJSONResponse(status_code=500, content=catastro_data)
 
     # 2. Ejecutar Análisis Vectorial y Generar Mapas (Módulo Vector Analyzer)
     # El vector_engine crea los .png automáticamente en la carpeta de la referencia
-    analisis_gis = vector_engine.ejecutar_analisis_completo(ref, catastro_data["kml"])
+    analisis_gis = await run_in_threadpool(vector_engine.ejecutar_analisis_completo, ref, catastro_data["kml"])
 
     return {
         "status": "success",
@@ -90,6 +98,74 @@ async def query_catastro(data: dict = Body(...)):
         "analisis": analisis_gis
     }
 
+def _construir_informe_pdf(ref, empresa, tecnico, colegiado, notas, incluir_archivos, logo):
+    """
+    Genera el PDF del informe. Es trabajo bloqueante (FPDF, disco), por eso se
+    llama desde el threadpool y no directamente en el endpoint.
+    """
+    from fpdf import FPDF
+    
+    # Sin duplicados, conservando el orden elegido en el frontend
+    mapas_seleccionados = list(dict.fromkeys(json.loads(incluir_archivos)))
+    
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+
+    # Manejo de Logo: se pasa a FPDF en memoria, sin fichero temporal en outputs/
+    if logo:
+        pdf.image(BytesIO(logo.file.read()), 10, 8, 33)
+        pdf.ln(20)
+
+    # Encabezado
+    pdf.set_font("Arial", 'B', 16)
+    pdf.cell(0, 10, "INFORME TÉCNICO DE AFECCIONES URBANÍSTICAS", 0, 1, 'C')
+    pdf.set_font("Arial", '', 11)
+    pdf.cell(0, 10, f"Referencia Catastral: {ref}", 0, 1, 'C')
+    pdf.ln(10)
+
+    # Tabla de Datos
+    pdf.set_fill_color(230, 230, 230)
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 10, "  IDENTIFICACIÓN DEL TÉCNICO", 0, 1, 'L', True)
+    pdf.set_font("Arial", '', 11)
+    pdf.cell(0, 8, f"Empresa: {empresa}", 0, 1)
+    pdf.cell(0, 8, f"Técnico: {tecnico}", 0, 1)
+    pdf.cell(0, 8, f"Colegiado: {colegiado}", 0, 1)
+    pdf.ln(5)
+
+    # Cuerpo de Notas
+    if notas:
+        pdf.set_font("Arial", 'B', 12)
+        pdf.cell(0, 10, "  NOTAS Y OBSERVACIONES", 0, 1, 'L', True)
+        pdf.set_font("Arial", '', 10)
+        pdf.multi_cell(0, 6, notas)
+        pdf.ln(5)
+
+    # Inserción de Mapas (Uno por página)
+    for img_url in mapas_seleccionados:
+        # Convertir URL (/outputs/...) a ruta local de archivo
+        # El img_url viene como "/outputs/REF123/REF123_capa.png"
+        relative_path = img_url.replace("/outputs/", "")
+        full_img_path = OUTPUT_DIR / relative_path
+
+        if full_img_path.exists():
+            pdf.add_page()
+            pdf.set_font("Arial", 'B', 14)
+            pdf.cell(0, 10, f"PLANO: {full_img_path.stem.replace(ref+'_', '')}", 0, 1, 'C')
+            # Ajustar imagen al ancho del PDF (A4 tiene ~210mm)
+            pdf.image(str(full_img_path), x=10, y=30, w=190)
+
+    # Guardar PDF final
+    report_filename = f"Informe_Final_{ref}.pdf"
+    report_path = OUTPUT_DIR / ref / report_filename
+    pdf.output(str(report_path))
+
+    return {
+        "status": "success",
+        "pdf_url": f"/outputs/{ref}/{report_filename}"
+    }
+
 @app.post("/api/report/generate")
 async def generate_final_report(
     ref: str = Form(...),
@@ -104,73 +180,11 @@ async def generate_final_report(
     PUNTO 5: Une todo en el PDF profesional.
     """
     try:
-        from fpdf import FPDF
-        
-        mapas_seleccionados = json.loads(incluir_archivos)
-        
-        pdf = FPDF()
-        pdf.set_auto_page_break(auto=True, margin=15)
-        pdf.add_page()
-
-        # Manejo de Logo
-        if logo:
-            logo_path = OUTPUT_DIR / f"temp_logo_{ref}_{logo.filename}"
-            with open(logo_path, "wb") as buffer:
-                shutil.copyfileobj(logo.file, buffer)
-            pdf.image(str(logo_path), 10, 8, 33)
-            pdf.ln(20)
-
-        # Encabezado
-        pdf.set_font("Arial", 'B', 16)
-        pdf.cell(0, 10, "INFORME TÉCNICO DE AFECCIONES URBANÍSTICAS", 0, 1, 'C')
-        pdf.set_font("Arial", '', 11)
-        pdf.cell(0, 10, f"Referencia Catastral: {ref}", 0, 1, 'C')
-        pdf.ln(10)
-
-        # Tabla de Datos
-        pdf.set_fill_color(230, 230, 230)
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 10, "  IDENTIFICACIÓN DEL TÉCNICO", 0, 1, 'L', True)
-        pdf.set_font("Arial", '', 11)
-        pdf.cell(0, 8, f"Empresa: {empresa}", 0, 1)
-        pdf.cell(0, 8, f"Técnico: {tecnico}", 0, 1)
-        pdf.cell(0, 8, f"Colegiado: {colegiado}", 0, 1)
-        pdf.ln(5)
-
-        # Cuerpo de Notas
-        if notas:
-            pdf.set_font("Arial", 'B', 12)
-            pdf.cell(0, 10, "  NOTAS Y OBSERVACIONES", 0, 1, 'L', True)
-            pdf.set_font("Arial", '', 10)
-            pdf.multi_cell(0, 6, notas)
-            pdf.ln(5)
-
-        # Inserción de Mapas (Uno por página)
-        for img_url in mapas_seleccionados:
-            # Convertir URL (/outputs/...) a ruta local de archivo
-            # El img_url viene como "/outputs/REF123/REF123_capa.png"
-            relative_path = img_url.replace("/outputs/", "")
-            full_img_path = OUTPUT_DIR / relative_path
-
-            if full_img_path.exists():
-                pdf.add_page()
-                pdf.set_font("Arial", 'B', 14)
-                pdf.cell(0, 10, f"PLANO: {full_img_path.stem.replace(ref+'_', '')}", 0, 1, 'C')
-                # Ajustar imagen al ancho del PDF (A4 tiene ~210mm)
-                pdf.image(str(full_img_path), x=10, y=30, w=190)
-
-        # Guardar PDF final
-        report_filename = f"Informe_Final_{ref}.pdf"
-        report_path = OUTPUT_DIR / ref / report_filename
-        pdf.output(str(report_path))
-
-        return {
-            "status": "success",
-            "pdf_url": f"/outputs/{ref}/{report_filename}"
-        }
-
+        return await run_in_threadpool(
+            _construir_informe_pdf, ref, empresa, tecnico, colegiado, notas, incluir_archivos, logo
+        )
     except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+        return ORJSONResponse(status_code=500, content={"error": str(e)})
 
 if __name__ == "__main__":
     import uvicorn
@@ -5,35 +5,57 @@ import xml.etree.ElementTree as ET
 from pathlib import Path
 from typing import List, Dict, Optional
 import logging
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Configuración de logs
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class AnalizadorUrbanistico:
+    # Límites de la caché de resultados del Catastro
+    CACHE_TTL_S = 3600
+    CACHE_MAX_REFERENCIAS = 512
+
     def __init__(self, output_base_dir: str = "outputs"):
         self.output_base_dir = Path(output_base_dir)
         self.output_base_dir.mkdir(parents=True, exist_ok=True)
         # URL del Servicio WFS de la Sede Electrónica del Catastro (España)
         self.ovc_url = "https://ovc.catastro.meh.es/ovcservweb/OVCSWLocalizacionRC/OVCCallejero.asmx"
+        # Resultados ya obtenidos por referencia (consulta -> informe repite la misma ref)
+        # referencia -> (instante de la consulta, resultado), del más antiguo al más reciente
+        self._cache_catastro: Dict[str, tuple] = {}
+        # referencia -> [lock, hilos que lo usan]; se elimina al quedar sin usuarios
+        self._locks_referencia: Dict[str, list] = {}
+        # Protege los dos diccionarios anteriores
+        self._guard = threading.Lock()
 
-    def procesar_lote_referencias(self, path_archivo: str, agrupar_por: str = "referencia") -> List[Dict]:
+    def procesar_lote_referencias(self, path_archivo: str, agrupar_por: str = "referencia", max_workers: int = 6) -> List[Dict]:
         """
         Lee un CSV/TXT y procesa cada referencia catastral incluida.
+        Las referencias son independientes entre sí, así que se procesan en paralelo
+        con un pool de hilos; los resultados se devuelven en el orden del archivo.
         """
-        resultados = []
         try:
             with open(path_archivo, 'r') as f:
                 # Soporta referencias separadas por comas, espacios o saltos de línea
                 contenido = f.read().replace(',', '\n').replace(' ', '\n')
                 referencias = [line.strip() for line in contenido.split('\n') if len(line.strip()) > 10]
-            
-            for ref in referencias:
-                logger.info(f"Procesando referencia de lote: {ref}")
-                res = self.obtener_datos_catastrales(ref)
-                resultados.append(res)
-            
-            return resultados
+
+            if not referencias:
+                return []
+
+            resultados_por_ref = {}
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(referencias))) as executor:
+                futures = {executor.submit(self.obtener_datos_catastrales, ref): ref for ref in dict.fromkeys(referencias)}
+                for future in as_completed(futures):
+                    ref = futures[future]
+                    logger.info(f"Referencia de lote procesada: {ref}")
+                    resultados_por_ref[ref] = future.result()
+
+            return [resultados_por_ref[ref] for ref in referencias]
         except Exception as e:
             logger.error(f"Error en procesar_lote_referencias: {e}")
             return [{"error": str(e)}]
@@ -41,7 +63,57 @@ class AnalizadorUrbanistico:
     def obtener_datos_catastrales(self, referencia: str) -> Dict:
         """
         Módulo 1: Obtiene geometría y datos de la parcela desde el Catastro.
+        Los resultados correctos se cachean por referencia (CACHE_TTL_S segundos, como
+        mucho CACHE_MAX_REFERENCIAS) mientras su KML siga en disco.
+        Si llegan varias peticiones de la misma referencia a la vez, solo una la genera
+        y el resto espera y reutiliza su resultado.
         """
+        cacheado = self._resultado_cacheado(referencia)
+        if cacheado:
+            return cacheado
+
+        with self._lock_referencia(referencia):
+            # Otra petición ha podido generarla mientras se esperaba el lock
+            cacheado = self._resultado_cacheado(referencia)
+            if cacheado:
+                return cacheado
+            return self._consultar_catastro(referencia)
+
+    def _resultado_cacheado(self, referencia: str) -> Optional[Dict]:
+        with self._guard:
+            entrada = self._cache_catastro.get(referencia)
+            if entrada is None:
+                return None
+            instante, cacheado = entrada
+            if time.monotonic() - instante > self.CACHE_TTL_S or not Path(cacheado["kml"]).exists():
+                del self._cache_catastro[referencia]
+                return None
+            return dict(cacheado)
+
+    def _guardar_en_cache(self, referencia: str, resultado: Dict):
+        with self._guard:
+            # Reinsertar la deja al final: el orden del dict es el de antigüedad
+            self._cache_catastro.pop(referencia, None)
+            self._cache_catastro[referencia] = (time.monotonic(), resultado)
+            while len(self._cache_catastro) > self.CACHE_MAX_REFERENCIAS:
+                del self._cache_catastro[next(iter(self._cache_catastro))]
+
+    @contextmanager
+    def _lock_referencia(self, referencia: str):
+        """Lock exclusivo de la referencia; se descarta cuando ningún hilo lo usa."""
+        with self._guard:
+            entrada = self._locks_referencia.setdefault(referencia, [threading.Lock(), 0])
+            entrada[1] += 1
+        try:
+            with entrada[0]:
+                yield
+        finally:
+            with self._guard:
+                entrada[1] -= 1
+                if entrada[1] == 0:
+                    del self._locks_referencia[referencia]
+
+    def _consultar_catastro(self, referencia: str) -> Dict:
         # Crear subcarpeta para esta referencia
         carpeta_ref = self.output_base_dir / referencia
         carpeta_ref.mkdir(parents=True, exist_ok=True)
@@ -58,12 +130,14 @@ class AnalizadorUrbanistico:
             # 2. Lógica de conversión (Módulo 1: GML a KML)
             self._generar_kml_basico(referencia, kml_path)
 
-            return {
+            resultado = {
                 "referencia": referencia,
                 "status": "success",
                 "folder": str(carpeta_ref),
                 "kml": str(kml_path)
             }
+            self._guardar_en_cache(referencia, resultado)
+            return dict(resultado)
         except Exception as e:
             logger.error(f"Error al obtener datos de {referencia}: {e}")
             return {"referencia": referencia, "status": "error", "message": str(e)}
@@ -99,6 +173,10 @@ class AnalizadorUrbanistico:
     </Placemark>
   </Document>
 </kml>"""
+        # No reescribir un KML idéntico: conserva su fecha de modificación y con ella
+        # los mapas ya generados a partir de él
+        if output_path.exists() and output_path.read_text(encoding='utf-8') == kml_content:
+            return
         with open(output_path, 'w', encoding='utf-8') as f:
             f.write(kml_content)
 
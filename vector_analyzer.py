@@ -1,115 +1,291 @@
 import os
-import json
-import geopandas as gpd
-import matplotlib.pyplot as plt
-from shapely.geometry import shape
-import fiona
+import importlib.util
+import logging
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from pyproj import CRS
+
+logger = logging.getLogger(__name__)
+
+# CRS de trabajo (ETRS89 / UTM 30N). Se construye una sola vez: comparar o
+# reproyectar contra la cadena "EPSG:25830" la vuelve a parsear en cada llamada.
+CRS_TRABAJO = CRS.from_epsg(25830)
+
+# Motor de lectura: pyogrio es bastante más rápido que Fiona; si no está instalado
+# se usa el motor por defecto de geopandas.
+IO_ENGINE = "pyogrio" if importlib.util.find_spec("pyogrio") else None
+# De las capas solo se usa la geometría: con pyogrio se omite la lectura de atributos (.dbf)
+LECTURA_SOLO_GEOMETRIA = {"columns": []} if IO_ENGINE == "pyogrio" else {}
+
+# matplotlib no es thread-safe (y GeoSeries.plot usa el estado global de pyplot):
+# los mapas se dibujan de uno en uno aunque varias peticiones se atiendan a la vez
+# desde el threadpool de FastAPI
+_RENDER_LOCK = threading.Lock()
+
+# CRS de cada capa por ruta: (estado de sus ficheros, CRS). Evita reabrir el dataset
+# en cada petición solo para leer su CRS (el driver GeoJSON recorre el fichero al abrirlo)
+_CRS_CAPAS = {}
+
+# Versión del diseño de los mapas. Forma parte de la firma de cada PNG generado:
+# incrementarla al cambiar cómo se dibujan invalida los mapas ya guardados
+VERSION_RENDER_MAPAS = "1"
+
+# Configuración de nombres amigables para el informe
+CONFIG_TITULOS = {
+    "vias_pecuarias": "Vías Pecuarias y Servidumbres",
+    "inundabilidad": "Riesgo de Inundación (PRTR)",
+    "urbanismo": "Calificación Urbanística Vigente",
+    "proteccion_ambiental": "Espacios Naturales Protegidos"
+}
 
 class VectorAnalyzer:
+    # Hilos para leer e intersectar capas en paralelo (GDAL y GEOS liberan el GIL)
+    MAX_WORKERS_CAPAS = 4
+    # Margen alrededor de la parcela en los mapas (metros)
+    MARGEN_MAPA_M = 200
+
     def __init__(self, output_dir="outputs", capas_dir="capas"):
         self.output_dir = Path(output_dir)
         self.capas_dir = Path(capas_dir)
-        self.config_titulos = self._cargar_config_titulos()
-
-    def _cargar_config_titulos(self):
-        # Configuración de nombres amigables para el informe
-        return {
-            "vias_pecuarias": "Vías Pecuarias y Servidumbres",
-            "inundabilidad": "Riesgo de Inundación (PRTR)",
-            "urbanismo": "Calificación Urbanística Vigente",
-            "proteccion_ambiental": "Espacios Naturales Protegidos"
-        }
+        self.config_titulos = CONFIG_TITULOS
 
     def ejecutar_analisis_completo(self, referencia, kml_path):
         """
         Ejecuta la intersección espacial y genera los mapas JPG.
         """
+        # Importación diferida: geopandas (GDAL, pandas...) tarda en cargar y
+        # solo se necesita cuando se analiza una parcela
+        import geopandas as gpd
+        from shapely.geometry import box
+
         results = []
         carpeta_ref = self.output_dir / referencia
         carpeta_ref.mkdir(parents=True, exist_ok=True)
 
         # 1. Cargar la parcela (KML)
         try:
-            parcela_gdf = gpd.read_file(kml_path)
+            parcela_gdf = gpd.read_file(kml_path, engine=IO_ENGINE)
             # Asegurar sistema de coordenadas proyectado (ej: EPSG:25830 para España)
-            if parcela_gdf.crs != "EPSG:25830":
-                parcela_gdf = parcela_gdf.to_crs("EPSG:25830")
+            if parcela_gdf.crs != CRS_TRABAJO:
+                parcela_gdf = parcela_gdf.to_crs(CRS_TRABAJO)
         except Exception as e:
             return {"error": f"Error leyendo KML: {e}"}
 
+        # Geometría de la parcela, calculada una sola vez para todas las capas
+        geom_parcela = parcela_gdf.unary_union
+
+        # Ventana del mapa (parcela + margen). Se usa como filtro bbox en la lectura
+        # de cada capa para que GDAL solo decodifique las entidades de la zona, no la
+        # capa entera (ver _bbox_en_crs_capa)
+        xmin, ymin, xmax, ymax = parcela_gdf.total_bounds
+        margen = self.MARGEN_MAPA_M
+        ventana = gpd.GeoSeries(
+            [box(xmin - margen, ymin - margen, xmax + margen, ymax + margen)],
+            crs=parcela_gdf.crs
+        )
+
         # 2. Analizar cada capa disponible en la carpeta /capas
-        for capa_file in os.listdir(self.capas_dir):
-            if capa_file.endswith(('.gpkg', '.geojson', '.shp')):
-                nombre_capa = Path(capa_file).stem
-                ruta_capa = self.capas_dir / capa_file
-                
-                # Procesar intersección
-                info_interseccion = self._analizar_capa_especifica(parcela_gdf, ruta_capa, nombre_capa)
-                
-                # Generar Mapa (Punto 3 y 4)
-                img_path = self._generar_captura_mapa(parcela_gdf, info_interseccion['gdf_capa'], referencia, nombre_capa)
-                
-                results.append({
-                    "capa": nombre_capa,
-                    "titulo": self.config_titulos.get(nombre_capa, nombre_capa),
-                    "afectado": info_interseccion['afectado'],
-                    "area_afectada": info_interseccion['area_m2'],
-                    "mapa_url": img_path
-                })
+        capas = [
+            (Path(capa_file).stem, self.capas_dir / capa_file)
+            for capa_file in os.listdir(self.capas_dir)
+            if capa_file.endswith(('.gpkg', '.geojson', '.shp'))
+        ]
+        if not capas:
+            return results
+
+        # Las capas son independientes: lectura e intersección en paralelo
+        with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS_CAPAS, len(capas))) as executor:
+            intersecciones = list(executor.map(
+                lambda capa: self._analizar_capa_especifica(ventana, geom_parcela, capa[1], capa[0]),
+                capas
+            ))
+
+        for (nombre_capa, ruta_capa), info_interseccion in zip(capas, intersecciones):
+            # Generar Mapa (Punto 3 y 4). matplotlib no es thread-safe: se dibuja en este hilo
+            img_path = self._generar_captura_mapa(
+                parcela_gdf, info_interseccion['gdf_capa'], referencia, nombre_capa,
+                fuentes=(kml_path, ruta_capa)
+            )
+
+            results.append({
+                "capa": nombre_capa,
+                "titulo": self.config_titulos.get(nombre_capa, nombre_capa),
+                "afectado": info_interseccion['afectado'],
+                "area_afectada": info_interseccion['area_m2'],
+                "mapa_url": img_path
+            })
 
         return results
 
-    def _analizar_capa_especifica(self, parcela_gdf, ruta_capa, nombre):
-        """Realiza el clipping espacial."""
-        capa_gdf = gpd.read_file(ruta_capa)
-        if capa_gdf.crs != parcela_gdf.crs:
-            capa_gdf = capa_gdf.to_crs(parcela_gdf.crs)
+    def _analizar_capa_especifica(self, ventana, geom_parcela, ruta_capa, nombre):
+        """Realiza el clipping espacial de la capa dentro de la ventana del mapa."""
+        import geopandas as gpd
+        import shapely
+
+        # El filtro bbox de GDAL se aplica en las unidades del propio fichero y geopandas
+        # no reproyecta la ventana con pyogrio: se pasa ya en el CRS de la capa
+        crs_capa = self._crs_capa(ruta_capa)
+        bbox = tuple(ventana.to_crs(crs_capa).total_bounds)
+        capa_gdf = gpd.read_file(ruta_capa, engine=IO_ENGINE, bbox=bbox, **LECTURA_SOLO_GEOMETRIA)
+        if capa_gdf.crs is None:
+            capa_gdf = capa_gdf.set_crs(crs_capa)
+        if capa_gdf.crs != ventana.crs:
+            capa_gdf = capa_gdf.to_crs(ventana.crs)
 
-        # Intersección
-        interseccion = gpd.overlay(parcela_gdf, capa_gdf, how='intersection')
-        
-        area_afectada = 0
-        if not interseccion.empty:
-            area_afectada = interseccion.area.sum()
+        # Intersección: el STRtree de la capa filtra candidatos y solo esos se recortan.
+        # Solo interesa el área, así que no hace falta el cruce de atributos de gpd.overlay.
+        idx = capa_gdf.sindex.query(geom_parcela, predicate="intersects")
+        candidatas = capa_gdf.geometry.values[idx]
+        # Las capas públicas traen a menudo anillos inválidos (autointersecciones) con los que
+        # GEOS falla al intersecar; se reparan con buffer(0), igual que hace gpd.overlay
+        invalidas = ~shapely.is_valid(candidatas)
+        if invalidas.any():
+            candidatas = candidatas.copy()
+            candidatas[invalidas] = shapely.buffer(candidatas[invalidas], 0)
+        areas = shapely.area(shapely.intersection(candidatas, geom_parcela))
+
+        # Como overlay, solo cuentan las intersecciones poligonales (área > 0)
+        area_afectada = float(areas.sum())
 
         return {
             "gdf_capa": capa_gdf,
-            "afectado": not interseccion.empty,
+            "afectado": bool((areas > 0).any()),
             "area_m2": round(area_afectada, 2)
         }
 
-    def _generar_captura_mapa(self, parcela_gdf, capa_gdf, referencia, nombre_capa):
+    @classmethod
+    def _crs_capa(cls, ruta_capa):
+        """
+        CRS declarado por la capa, cacheado mientras no cambien sus ficheros.
+        Si la capa no declara CRS (p. ej. un shapefile sin .prj) se asume el de trabajo.
+        """
+        estado = cls._estado_ficheros(Path(ruta_capa))
+        cacheado = _CRS_CAPAS.get(ruta_capa)
+        if cacheado and cacheado[0] == estado:
+            return cacheado[1]
+
+        if IO_ENGINE == "pyogrio":
+            import pyogrio
+            crs = pyogrio.read_info(ruta_capa)["crs"]
+        else:
+            import fiona
+            with fiona.open(ruta_capa) as src:
+                crs = src.crs_wkt or None
+
+        if crs:
+            crs = CRS.from_user_input(crs)
+        else:
+            logger.warning(f"La capa {ruta_capa} no declara CRS: se asume EPSG:{CRS_TRABAJO.to_epsg()}")
+            crs = CRS_TRABAJO
+
+        _CRS_CAPAS[ruta_capa] = (estado, crs)
+        return crs
+
+    def _generar_captura_mapa(self, parcela_gdf, capa_gdf, referencia, nombre_capa, fuentes=()):
         """
         Crea un archivo PNG/JPG con el diseño del mapa para el informe.
+        Si el PNG ya existe y su firma (ficheros de `fuentes`, título, margen y
+        versión de render) no ha cambiado, se reutiliza en lugar de volver a dibujarlo.
         """
-        fig, ax = plt.subplots(figsize=(10, 8))
-        
-        # 1. Dibujar la capa de fondo (ej: inundabilidad) en color suave
-        capa_gdf.plot(ax=ax, color='blue', alpha=0.3, edgecolor='blue', linewidth=0.5)
-        
-        # 2. Dibujar la parcela con un borde rojo grueso
-        parcela_gdf.plot(ax=ax, facecolor="none", edgecolor="red", linewidth=2.5, label="Parcela Analizada")
-        
-        # 3. Zoom a la parcela con un margen (buffer)
-        bounds = parcela_gdf.total_bounds
-        margin = 200 # metros
-        ax.set_xlim([bounds[0] - margin, bounds[2] + margin])
-        ax.set_ylim([bounds[1] - margin, bounds[3] + margin])
-
-        # Estética
-        titulo = self.config_titulos.get(nombre_capa, nombre_capa).upper()
-        plt.title(f"{titulo}\nRef: {referencia}", fontsize=14, fontweight='bold')
-        ax.set_axis_off()
-        
-        # Guardar imagen
         output_name = f"{referencia}_{nombre_capa}.png"
         save_path = self.output_dir / referencia / output_name
-        plt.savefig(save_path, dpi=150, bbox_inches='tight')
-        plt.close()
-        
+        firma_path = save_path.with_name(f"{output_name}.firma")
+        url = f"/outputs/{referencia}/{output_name}"
+
+        firma = self._firma_mapa(nombre_capa, fuentes) if fuentes else None
+        if firma and save_path.exists() and self._leer_firma(firma_path) == firma:
+            return url
+
+        # El mapa se dibuja en una Figure propia, que no pasa por el gestor de figuras de
+        # pyplot: no hace falta plt.close() y no queda registrada si algo falla. Aun así
+        # GeoSeries.plot importa pyplot y termina con plt.draw(), que crea y dibuja la
+        # figura "actual" global de pyplot; por eso el dibujo sigue bajo _RENDER_LOCK
+        from matplotlib.figure import Figure
+
+        figsize, dpi = (10, 8), 150
+
+        # Encuadre: parcela con un margen (buffer)
+        bounds = parcela_gdf.total_bounds
+        margin = self.MARGEN_MAPA_M
+        xmin, ymin, xmax, ymax = bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin
+
+        # Solo se dibuja lo visible: la capa se recorta al encuadre (con holgura para que
+        # el borde del recorte quede fuera de la imagen) y se simplifica a medio píxel,
+        # así matplotlib no procesa vértices que no llegan a verse
+        tam_pixel = (xmax - xmin) / (figsize[0] * dpi)
+        holgura = 10 * tam_pixel
+        capa_visible = capa_gdf.geometry.clip_by_rect(xmin - holgura, ymin - holgura, xmax + holgura, ymax + holgura)
+        capa_visible = capa_visible[~capa_visible.is_empty].simplify(tam_pixel / 2)
+
+        with _RENDER_LOCK:
+            fig = Figure(figsize=figsize)
+            ax = fig.add_subplot()
+
+            # 1. Dibujar la capa de fondo (ej: inundabilidad) en color suave
+            capa_visible.plot(ax=ax, color='blue', alpha=0.3, edgecolor='blue', linewidth=0.5)
+
+            # 2. Dibujar la parcela con un borde rojo grueso
+            parcela_gdf.plot(ax=ax, facecolor="none", edgecolor="red", linewidth=2.5, label="Parcela Analizada")
+
+            # 3. Zoom a la parcela con un margen (buffer)
+            ax.set_xlim([xmin, xmax])
+            ax.set_ylim([ymin, ymax])
+
+            # Estética
+            titulo = self.config_titulos.get(nombre_capa, nombre_capa).upper()
+            ax.set_title(f"{titulo}\nRef: {referencia}", fontsize=14, fontweight='bold')
+            ax.set_axis_off()
+
+            # Guardar imagen
+            fig.savefig(save_path, dpi=dpi, bbox_inches='tight')
+
+        if firma:
+            firma_path.write_text(firma, encoding='utf-8')
+
         # Retornar ruta relativa para el frontend
-        return f"/outputs/{referencia}/{output_name}"
+        return url
+
+    def _firma_mapa(self, nombre_capa, fuentes):
+        """
+        Firma de los datos y parámetros de los que sale un mapa. Usa tamaño y mtime
+        exactos de cada fichero (comparados por igualdad, no por antigüedad, para no
+        fallar con copias que conservan fechas: cp -p, rsync, COPY de Docker).
+        """
+        partes = [
+            VERSION_RENDER_MAPAS,
+            self.config_titulos.get(nombre_capa, nombre_capa),
+            str(self.MARGEN_MAPA_M),
+        ]
+        try:
+            for fuente in fuentes:
+                partes.extend(self._estado_ficheros(Path(fuente)))
+        except OSError:
+            return None
+        return "\n".join(partes)
+
+    @classmethod
+    def _estado_ficheros(cls, ruta):
+        """Nombre, tamaño y mtime exacto de cada fichero de una fuente."""
+        estado = []
+        for fichero in cls._ficheros_de_fuente(ruta):
+            st = fichero.stat()
+            estado.append(f"{fichero.name}:{st.st_size}:{st.st_mtime_ns}")
+        return estado
+
+    @staticmethod
+    def _ficheros_de_fuente(ruta):
+        """Un shapefile son varios ficheros (.shp, .shx, .dbf, .prj, .cpg...): cuentan todos."""
+        if ruta.suffix.lower() != ".shp":
+            return [ruta]
+        return sorted(p for p in ruta.parent.iterdir() if p.stem == ruta.stem and p.is_file())
+
+    @staticmethod
+    def _leer_firma(firma_path):
+        try:
+            return firma_path.read_text(encoding='utf-8')
+        except OSError:
+            return None
 
 # Función de compatibilidad para main.py
 def procesar_parcelas(referencia, kml_path):